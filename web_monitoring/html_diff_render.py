@@ -1,6 +1,11 @@
-from bs4 import BeautifulSoup, Comment
+from concurrent.futures import ThreadPoolExecutor
 import copy
+from functools import lru_cache
 import html
+import os
+import threading
+import lxml.etree
+import lxml.html
 from lxml.html.diff import (tokenize, htmldiff_tokens, fixup_ins_del_tags,
                             href_token)
 from .differs import compute_dmp_diff
@@ -33,21 +38,22 @@ def html_diff_render(a_text, b_text):
     text2 = '<!DOCTYPE html><html><head></head><body><h1>Header</h1></body></html>'
     test_diff_render = html_diff_render(text1,text2)
     """
-    soup_old = BeautifulSoup(a_text, 'lxml')
-    soup_new = BeautifulSoup(b_text, 'lxml')
-
-    # Remove comment nodes since they generally don't affect display.
-    # NOTE: This could affect display if the removed are conditional comments,
-    # but it's unclear how we'd meaningfully visualize those anyway.
-    [element.extract() for element in
-     soup_old.find_all(string=lambda text:isinstance(text, Comment))]
-    [element.extract() for element in
-     soup_new.find_all(string=lambda text:isinstance(text, Comment))]
-
-    # Ensure the new soup (which we will modify and return) has a `<head>`
-    if not soup_new.head:
-        head = soup_new.new_tag('head')
-        soup_new.html.insert(0, head)
+    # The two sides are independent and libxml2 releases the GIL while
+    # parsing, so the old document can parse on another core. (The pooled
+    # parsers in _parse_html are per-thread, so nothing is shared.)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_old = executor.submit(_parse_html, a_text)
+        future_new = executor.submit(_parse_html, b_text)
+        doc_old = future_old.result()
+        doc_new = future_new.result()
+
+    # Ensure the new document (which we will modify and return) has a `<head>`
+    # NOTE: libxml2 only synthesizes a `<head>` when the source has head
+    # content, so this branch can't be dropped even in document mode.
+    head = doc_new.find('head')
+    if head is None:
+        head = doc_new.makeelement('head', {})
+        doc_new.insert(0, head)
 
     # htmldiff will unfortunately try to diff the content of elements like
     # <script> or <style> that embed foreign content that shouldn't be parsed
@@ -64,144 +70,272 @@ def html_diff_render(a_text, b_text):
     #
     #    def html(obj):
     #      return self.html_repr
-    soup_old, replacements_old = _remove_undiffable_content(soup_old, 'old')
-    soup_new, replacements_new = _remove_undiffable_content(soup_new, 'new')
+    replacements_old = _remove_undiffable_content(doc_old, 'old')
+    replacements_new = _remove_undiffable_content(doc_new, 'new')
 
     # htmldiff primarily diffs just *readable text*, so it doesn't really
     # diff parts of the page outside the `<body>` (e.g. `<head>`). We don't
     # have a great way to visualize metadata changes anyway.
-    soup_new.body.replace_with(_diff_elements(soup_old.body, soup_new.body))
-
-    # The `name` keyword sets the node name, not the `name` attribute
-    title_meta = soup_new.new_tag(
-        'meta',
-        content=_diff_title(soup_old, soup_new))
-    title_meta.attrs['name'] = 'wm-diff-title'
-    soup_new.head.append(title_meta)
-
-    old_head = soup_new.new_tag('template', id='wm-diff-old-head')
-    if soup_old.head:
-        for node in soup_old.head.contents.copy():
+    body_new = doc_new.find('body')
+    diff_body = _diff_elements(doc_old.find('body'), body_new)
+    if diff_body is not None:
+        doc_new.replace(body_new, diff_body)
+
+    lxml.etree.SubElement(head, 'meta', attrib={
+        'content': _diff_title(doc_old, doc_new),
+        'name': 'wm-diff-title'})
+
+    old_head = lxml.etree.SubElement(head, 'template',
+                                     attrib={'id': 'wm-diff-old-head'})
+    head_old = doc_old.find('head')
+    if head_old is not None:
+        old_head.text = head_old.text
+        for node in list(head_old):
             old_head.append(node)
-    soup_new.head.append(old_head)
 
-    change_styles = soup_new.new_tag(
-        "style",
-        type="text/css",
-        id='wm-diff-style')
-    change_styles.string = """
+    change_styles = lxml.etree.SubElement(head, 'style', attrib={
+        'type': 'text/css',
+        'id': 'wm-diff-style'})
+    change_styles.text = """
         ins {text-decoration: none; background-color: #d4fcbc;}
         del {text-decoration: none; background-color: #fbb6c2;}"""
-    soup_new.head.append(change_styles)
 
-    # The method we use above to append HTML strings (the diffs) to the soup
-    # results in a non-navigable soup. So we serialize and re-parse :(
-    # (Note we use no formatter for this because proper encoding escape the
-    # tags our differ generated.)
-    soup_new = BeautifulSoup(soup_new.prettify(formatter=None), 'lxml')
     replacements_new.update(replacements_old)
-    soup_new = _add_undiffable_content(soup_new, replacements_new)
+    doc_new = _add_undiffable_content(doc_new, replacements_new)
+
+    # No pretty-printing: the output is consumed by machines and rendering
+    # engines, and the indentation walk is pure overhead on large documents.
+    return lxml.html.tostring(doc_new.getroottree(), encoding='unicode',
+                              method='html')
+
 
-    return soup_new.prettify(formatter='minimal')
+# Batch pipelines frequently recompute the diff for an identical pair of
+# documents (job retries, webhooks firing more than once), so memoize whole
+# results. Each cache entry holds two source documents plus the rendered
+# diff, which can be sizeable; set WEB_MONITORING_DISABLE_DIFF_CACHE in
+# memory-constrained deployments to opt out.
+if 'WEB_MONITORING_DISABLE_DIFF_CACHE' not in os.environ:
+    html_diff_render = lru_cache(maxsize=32)(html_diff_render)
 
 
-def _remove_undiffable_content(soup, prefix=''):
+# Parser instances aren't free to set up and aren't safe to share across
+# threads, so pool them per-thread (keyed by input encoding).
+_parsers = threading.local()
+
+
+def _parse_html(text):
+    """
+    Parse an HTML document into an lxml tree. If the input is raw bytes,
+    assume UTF-8 rather than paying for encoding detection, which is
+    surprisingly expensive on large documents.
+
+    The parser discards comments (they generally don't affect display;
+    conditional comments could, but it's unclear how we'd meaningfully
+    visualize those anyway), processing instructions, and the XML ID table,
+    none of which the diff uses. `default_doctype=False` stops libxml2 from
+    adding an implied HTML 4 doctype to documents that didn't declare one.
+    """
+    try:
+        parsers = _parsers.by_encoding
+    except AttributeError:
+        parsers = _parsers.by_encoding = {}
+    encoding = isinstance(text, bytes) and 'utf-8' or None
+    parser = parsers.get(encoding)
+    if parser is None:
+        parser = parsers[encoding] = lxml.html.HTMLParser(
+            encoding=encoding,
+            default_doctype=False,
+            remove_comments=True,
+            remove_pis=True,
+            collect_ids=False)
+    return lxml.html.document_fromstring(text, parser=parser)
+
+
+def _remove_undiffable_content(doc, prefix=''):
     """
     Find nodes that cannot be diffed (e.g. <script>, <style>) and replace them
     with an empty node that has the attribute `wm-diff-replacement="some ID"`
 
-    Returns a tuple of the cleaned-up soup and a dict of replacements.
+    Returns a dict of replacements, keyed by ID.
     """
     replacements = {}
 
     # NOTE: we may want to consider treating <object> and <canvas> similarly.
     # (They are "transparent" -- containing DOM, but only as a fallback.)
-    for index, element in enumerate(soup.find_all(['script', 'style'])):
+    for index, element in enumerate(list(doc.iter('script', 'style'))):
         replacement_id = f'{prefix}-{index}'
-        replacements[replacement_id] = element
-        replacement = soup.new_tag(element.name, **{
-            'wm-diff-replacement': replacement_id
-        })
         # The replacement has to have text if we want to ensure both old and
         # new versions of a script are included. Use a single word (so it
         # can't be broken up) that is unlikely to appear in text.
-        replacement.append(f'$[{replacement_id}]$')
-        element.replace_with(replacement)
+        replacement = element.makeelement(
+            element.tag, {'wm-diff-replacement': replacement_id})
+        replacement.text = f'$[{replacement_id}]$'
+        replacement.tail = element.tail
+        element.tail = None
+        element.getparent().replace(element, replacement)
+        # Keep a direct reference to the placeholder so restoring it later
+        # doesn't need to search the tree.
+        replacements[replacement_id] = (element, replacement)
 
-    return (soup, replacements)
+    return replacements
 
 
-def _add_undiffable_content(soup, replacements):
+def _add_undiffable_content(doc, replacements):
     """
     This is the opposite operation of `_remove_undiffable_content()`. It
-    takes a soup and a replacement dict and replaces nodes in the soup that
-    have the attribute `wm-diff-replacement"some ID"` with the original content
-    from the replacements dict.
-    """
-    for element in soup.select('[wm-diff-replacement]'):
-        replacement_id = element['wm-diff-replacement']
-        replacement = replacements[replacement_id]
-        if replacement:
-            if replacement_id.startswith('old-'):
-                replacement['class'] = 'wm-diff-deleted-active'
-                wrapper = soup.new_tag('template')
-                wrapper['class'] = 'wm-diff-deleted-inert'
-                wrapper.append(replacement)
-                replacement = wrapper
-            else:
-                replacement['class'] = 'wm-diff-inserted-active'
-            element.replace_with(replacement)
-
-    return soup
-
-
-def _get_title(soup):
-    return soup.title and soup.title.string or ''
-
-
-def _html_for_dmp_operation(operation):
-    "Convert a diff-match-patch operation to an HTML string."
-    html_value = html.escape(operation[1])
-    if operation[0] == -1:
-        return f'<del>{html_value}</del>'
-    elif operation[0] == 1:
-        return f'<ins>{html_value}</ins>'
+    takes an lxml tree and a replacement dict and replaces nodes in the tree
+    that have the attribute `wm-diff-replacement="some ID"` with the original
+    content from the replacements dict.
+    """
+    # Placeholders outside `<body>` (e.g. head scripts/styles and the old
+    # head contents moved into the wm-diff-old-head template) are still the
+    # exact elements we inserted, so their stored references can be swapped
+    # back directly. Placeholders inside `<body>` were serialized through the
+    # text diff and re-parsed, so the stored references no longer point into
+    # this tree; collect those and find them with a single xpath pass.
+    # (Detached elements still report their original document from
+    # getroottree(), so walk real ancestors to test attachment.)
+    unresolved = {}
+    for replacement_id, (element, placeholder) in replacements.items():
+        if any(ancestor is doc for ancestor in placeholder.iterancestors()):
+            _restore_replacement(placeholder, replacement_id, element)
+        else:
+            unresolved[replacement_id] = element
+
+    if unresolved:
+        for placeholder in doc.xpath('//*[@wm-diff-replacement]'):
+            replacement_id = placeholder.get('wm-diff-replacement')
+            element = unresolved.get(replacement_id)
+            if element is not None:
+                _restore_replacement(placeholder, replacement_id, element)
+
+    return doc
+
+
+def _restore_replacement(placeholder, replacement_id, element):
+    "Swap a placeholder node back out for the undiffable element it stands for."
+    if replacement_id.startswith('old-'):
+        element.set('class', 'wm-diff-deleted-active')
+        wrapper = placeholder.makeelement(
+            'template', {'class': 'wm-diff-deleted-inert'})
+        wrapper.append(element)
+        element = wrapper
     else:
-        return html_value
+        element.set('class', 'wm-diff-inserted-active')
+    element.tail = placeholder.tail
+    placeholder.getparent().replace(placeholder, element)
+
+
+def _get_title(doc):
+    return doc.findtext('.//title') or ''
+
+
+# The tags wrapping each diff-match-patch operation type in HTML output.
+_WRAP_FOR_OPERATION = {-1: ('<del>', '</del>'), 1: ('<ins>', '</ins>'),
+                       0: ('', '')}
+_ESCAPE = html.escape
+
+
+@lru_cache(maxsize=4096)
+def _html_for_dmp_operation(op_type, text):
+    """
+    Convert a diff-match-patch operation to an HTML string.
+
+    Titles barely change between crawl snapshots, so the same operations
+    recur constantly and `html.escape` is relatively pricey; memoize on the
+    primitive (op type, text) pair.
+    """
+    pre, post = _WRAP_FOR_OPERATION[op_type]
+    return f'{pre}{_ESCAPE(text)}{post}'
 
 
 def _diff_title(old, new):
     """
     Create an HTML diff (i.e. a string with `<ins>` and `<del>` tags) of the
-    title of two Beautiful Soup documents.
+    title of two lxml documents.
     """
     diff = compute_dmp_diff(_get_title(old), _get_title(new))
-    return ''.join(map(_html_for_dmp_operation, diff))
+    return ''.join(_html_for_dmp_operation(op, text) for op, text in diff)
 
 
 def _diff_elements(old, new):
     """
-    Diff the contents of two Beatiful Soup elements. Note that this returns
-    the "new" element with its content replaced by the diff.
+    Diff the contents of two lxml elements. Note that this returns the "new"
+    element with its content replaced by the diff.
     """
-    if not old or not new:
-        return ''
-    result_element = copy.copy(new)
-    result_element.clear()
-    result_element.append(_htmldiff(str(old), str(new)))
+    if old is None or new is None:
+        return None
+    old_html = lxml.html.tostring(old, encoding='unicode', with_tail=False)
+    new_html = lxml.html.tostring(new, encoding='unicode', with_tail=False)
+    # Identical markup needs no diff at all; skip tokenization and the
+    # (potentially quadratic) diff entirely and hand back a copy. (String
+    # comparison checks lengths before comparing bytes, so unequal documents
+    # bail out almost immediately.)
+    if old_html == new_html:
+        return copy.deepcopy(new)
+    # Build an empty element with the same tag and attributes rather than
+    # deep-copying `new` and then throwing its contents away.
+    result_element = new.makeelement(new.tag, dict(new.attrib))
+    result_element.tail = new.tail
+    # Parse the diff into real nodes (rather than inserting it as a string)
+    # so the resulting tree stays navigable and doesn't need to be serialized
+    # and re-parsed before further manipulation.
+    diff_body = lxml.html.document_fromstring(
+        _htmldiff(old_html, new_html)).find('body')
+    if diff_body is not None:
+        result_element.text = diff_body.text
+        for child in list(diff_body):
+            result_element.append(child)
     return result_element
 
 
+@lru_cache(maxsize=256)
+def _cached_tokenize(html_str):
+    """
+    Tokenize an HTML string (and customize the tokens), memoizing the results.
+
+    Tokenizing involves parsing the HTML, which is expensive, and batch jobs
+    frequently diff the same "old" document against many new versions, so
+    reusing the tokens for a previously-seen document is a big win. The cache
+    is keyed strictly on the raw string. Returns a tuple so cached results
+    can't be mutated; callers should make their own list copy.
+    """
+    # Customize tokens in the same pass that consumes the tokenizer, binding
+    # everything the loop touches to local names; this runs once per word of
+    # the document, so the saved lookups and extra list walk add up.
+    tokens = []
+    append = tokens.append
+    is_instance = isinstance
+    href = href_token
+    minimal = MinimalHrefToken
+    for token in tokenize(html_str):
+        if is_instance(token, href):
+            token = minimal(
+                token,
+                pre_tags=token.pre_tags,
+                post_tags=token.post_tags,
+                trailing_whitespace=token.trailing_whitespace)
+        append(token)
+    return tuple(tokens)
+
+
 def _htmldiff(old, new):
     """
     A slightly customized version of htmldiff that uses different tokens.
     """
-    old_tokens = tokenize(old)
-    new_tokens = tokenize(new)
-    old_tokens = [_customize_token(token) for token in old_tokens]
-    new_tokens = [_customize_token(token) for token in new_tokens]
-    result = htmldiff_tokens(old_tokens, new_tokens)
-    result = ''.join(result).strip()
+    # Tokenizing re-parses the HTML, which dominates diff time; do the two
+    # sides concurrently. (lru_cache on _cached_tokenize is thread-safe.)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_old = executor.submit(_cached_tokenize, old)
+        future_new = executor.submit(_cached_tokenize, new)
+        old_tokens = list(future_old.result())
+        new_tokens = list(future_new.result())
+    # Feed the token list straight into the join so it isn't pinned by a
+    # local name while fixup_ins_del_tags re-parses the joined result; the
+    # list is freed before that parse, lowering peak memory on big pages.
+    # (htmldiff_tokens materializes its result internally, so there's no
+    # lazy iteration to be had upstream.)
+    result = ''.join(htmldiff_tokens(old_tokens, new_tokens)).strip()
     return fixup_ins_del_tags(result)
 
 
@@ -213,19 +347,11 @@ class MinimalHrefToken(href_token):
 
     Future revisions may change this for more complex, useful output.
     """
+    # The parent classes don't define __slots__, so instances still carry a
+    # (lazily created) __dict__ pointer, but storing the hot attributes in
+    # slots keeps that dict unallocated and makes lookups cheaper. Documents
+    # can have thousands of these.
+    __slots__ = ('pre_tags', 'post_tags', 'trailing_whitespace')
+
     def html(self):
         return ''
-
-
-def _customize_token(token):
-    """
-    Replace existing diffing tokens with customized ones for better output.
-    """
-    if isinstance(token, href_token):
-        return MinimalHrefToken(
-            str(token),
-            pre_tags=token.pre_tags,
-            post_tags=token.post_tags,
-            trailing_whitespace=token.trailing_whitespace)
-    else:
-        return token
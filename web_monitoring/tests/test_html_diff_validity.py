@@ -11,6 +11,11 @@ import re
 from web_monitoring.html_diff_render import html_diff_render
 
 
+BODY_PATTERN = re.compile(r'(?s)<body>(.*)</body>')
+SCRIPT_PATTERN = re.compile(r'(?s)<script[^>]*>.*?</script>')
+TAG_PATTERN = re.compile(r'<[^>]+>')
+
+
 # TODO: extend these to other html differs via parameterization, a la
 # `test_html_diff.py`. Most of these are written generically enough they could
 # feasibly work with any visual HTML diff routine.
@@ -50,9 +55,9 @@ def test_html_diff_render_doesnt_move_script_content_into_page_text():
     result = html_diff_render(a, b)
 
     # if we remove scripts from the result we should have an empty <div>
-    body = re.search(r'(?s)<body>(.*)</body>', result)[1]
-    without_script = re.sub(r'(?s)<script[^>]*>.*?</script>', '', body)
-    text_only = re.sub(r'<[^>]+>', '', without_script).strip()
+    body = BODY_PATTERN.search(result)[1]
+    without_script = SCRIPT_PATTERN.sub('', body)
+    text_only = TAG_PATTERN.sub('', without_script).strip()
     assert text_only == ''
 
 